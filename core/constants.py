@@ -35,6 +35,9 @@ SETTINGS_FILE = "settings.toml"
 DATA_FOLDER = "dados"
 """Folder name to store the datasets used by the bots."""
 
+INVESTIGATION_WORKERS = 8
+"""Default number of patients investigated in parallel (each one with your own Sinan session)."""
+
 POSSIBLE_EXAM_TYPES = Literal["IgM", "NS1", "PCR"]
 
 EXAMS_GAL_MAP: dict[str, POSSIBLE_EXAM_TYPES] = {
@@ -123,9 +126,23 @@ SCRIPT_GENERATED_PATH = Path("script")
 
 SCRIPT_GENERATED_PATH.mkdir(exist_ok=True)
 
+DATA_CACHE_PATH = SCRIPT_GENERATED_PATH / "cache"
+"""The path to save the datasets converted to parquet (faster to load than excel)."""
+
+DATA_CACHE_PATH.mkdir(exist_ok=True)
+
 UNIVERSAL_STATS_FILE_PATH = SCRIPT_GENERATED_PATH / "stats.json"
 """The path to save the universal statistics where will be saved the stats between executions."""
 
+POSSIBLE_OUTPUT_FORMATS = Literal["xlsx", "parquet", "csv"]
+"""[TypeHint] Possible file formats of the investigation report"""
+
+POSSIBLE_OUTPUT_FORMATS_LIST: list[POSSIBLE_OUTPUT_FORMATS] = ["xlsx", "parquet", "csv"]
+"""List of possible file formats of the investigation report"""
+
+REPORT_OUTPUT_FORMAT: POSSIBLE_OUTPUT_FORMATS = "parquet"
+"""Default file format of the investigation report"""
+
 
 SEARCH_POSSIBLE_CRITERIAS = Literal[
     "Nome do paciente",
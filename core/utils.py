@@ -1,38 +1,81 @@
+import functools
 import os
 import re
 from pathlib import Path
 from typing import List, Optional, Union
 
 import pandas as pd
+from pandas.api.types import infer_dtype
 import requests
 import toml
-from bs4 import BeautifulSoup, NavigableString, Tag
+from bs4 import BeautifulSoup, NavigableString, SoupStrainer, Tag
+from bs4.builder import builder_registry
 from dbfread import DBF
 
 from .constants import (
     CRITERIA_OPERATIONS,
     CURRENT_YEAR_FIRST_DAY,
+    DATA_CACHE_PATH,
+    INVESTIGATION_WORKERS,
     POSSIBLE_AGRAVOS,
     POSSIBLE_AGRAVOS_LIST,
     POSSIBLE_MUNICIPALITIES_LIST,
+    POSSIBLE_OUTPUT_FORMATS_LIST,
     SEARCH_POSSIBLE_CRITERIAS_LIST,
     SETTINGS_FILE,
     TODAY_FORMATTED,
     TODAY_MONTH_FORMATTED,
 )
 
+_WS_RE = re.compile(r"\s+")
+"""Whitespace sequences (collapsed to a single space on names normalization)"""
+
+_LXML_BUILDER = builder_registry.lookup("lxml")
+"""lxml tree builder class resolved once (each parse instantiates your own builder)"""
+
 
 def clear_screen():
     """Clear the console screen"""
     os.system("cls" if os.name == "nt" else "clear")
 
 
+def load_excel(path: Path) -> pd.DataFrame:
+    """Load an excel file using the parquet cache when it is up to date
+
+    The first load reads the excel with the `calamine` engine and saves a parquet copy
+    in `DATA_CACHE_PATH`, the next loads read the parquet copy while the excel file
+    keeps the same size and modification time (saved on the parquet metadata).
+
+    Args:
+        path (Path): Path to the excel file
+
+    Returns:
+        pd.DataFrame: Dataframe with loaded data
+    """
+    cache = DATA_CACHE_PATH / path.with_suffix(".parquet").name
+    stat = path.stat()
+    source = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+    if cache.exists():
+        df = pd.read_parquet(cache)
+        if df.attrs.get("source") == source:
+            return df
+
+    df = pd.read_excel(path, engine="calamine")
+    df.attrs["source"] = source
+    try:
+        df.to_parquet(cache, index=False)
+    except (TypeError, ValueError):
+        # columns with mixed types can't be saved as parquet, just skip the cache
+        cache.unlink(missing_ok=True)
+    return df
+
+
 def load_data(path: Path) -> pd.DataFrame:
     """Load data from file
 
     Args:
         path (Path): Path to file.
-            Allowed extensions: `.csv`, `.xlsx`, `.dbf`
+            Allowed extensions: `.csv`, `.xlsx`, `.dbf`, `.parquet`
 
     Raises:
         ValueError: Unsupported file type
@@ -43,11 +86,20 @@ def load_data(path: Path) -> pd.DataFrame:
     ext = path.suffix
     match ext:
         case ".csv":
-            return pd.read_csv(path, sep=";", encoding="latin-1")
+            # the pyarrow engine parses the csv using multiple threads
+            return pd.read_csv(path, sep=";", encoding="latin-1", engine="pyarrow")
         case ".xlsx":
-            return pd.read_excel(path)
+            return load_excel(path)
+        case ".parquet":
+            return pd.read_parquet(path)
         case ".dbf":
-            return pd.DataFrame(iter(DBF(path, encoding="latin-1")))
+            # records as plain tuples (lighter than the default OrderedDict per row)
+            dbf = DBF(
+                path,
+                encoding="latin-1",
+                recfactory=lambda items: tuple(value for _, value in items),
+            )
+            return pd.DataFrame.from_records(iter(dbf), columns=dbf.field_names)
         case _:
             raise ValueError(f"Unsupported file type: {ext}")
 
@@ -63,7 +115,13 @@ def normalize_name(name: str) -> str:
     """
     if not isinstance(name, str):
         return name
-    return re.sub(r"\s+", " ", name).strip().upper()
+    return _normalize_str(name)
+
+
+@functools.lru_cache(maxsize=100_000)
+def _normalize_str(name: str) -> str:
+    """Cached normalization of a string (names repeat a lot between rows)"""
+    return _WS_RE.sub(" ", name).strip().upper()
 
 
 def normalize_columns(df: pd.DataFrame, columns: List[str]):
@@ -74,19 +132,50 @@ def normalize_columns(df: pd.DataFrame, columns: List[str]):
         columns (List[str]): List of columns to normalize
     """
     for column in columns:
-        df[column] = df[column].apply(lambda x: normalize_name(x))
+        series = df[column]
+        # an empty (all NaN) column is read as float, without the `.str` accessor
+        if infer_dtype(series, skipna=True) == "string":
+            df[column] = (
+                series.str.replace(_WS_RE.pattern, " ", regex=True)
+                .str.strip()
+                .str.upper()
+            )
+        else:
+            # mixed types or empty: keep non string values untouched
+            df[column] = series.map(normalize_name)
 
 
-def to_datetime(df: pd.DataFrame, columns: List[str], **kw):
+def to_datetime(
+    df: pd.DataFrame, columns: List[str], format: Optional[str] = None, **kw
+):
     """Inplace conversion of columns to datetime
 
     Args:
         df (pd.DataFrame): Dataframe with columns to convert
         columns (List[str]): List of columns to convert
+        format (str, optional): Date format of the columns (skips the per value format inference).
+            Defaults to `None`.
         **kw: Keyword arguments to pass to pd.to_datetime
     """
+    kw.setdefault("cache", True)
     for column in columns:
-        df[column] = pd.to_datetime(df[column], **kw)
+        df[column] = pd.to_datetime(df[column], format=format, **kw)
+
+
+def parse_html(
+    content: bytes, strainer: Optional[SoupStrainer] = None
+) -> BeautifulSoup:
+    """Parse a html page with BeautifulSoup using the lxml parser
+
+    Args:
+        content (bytes): The page content (eg. `response.content`)
+        strainer (SoupStrainer, optional): Restrict the parsing to the matched tags.
+            Defaults to `None`.
+
+    Returns:
+        BeautifulSoup: The parsed page
+    """
+    return BeautifulSoup(content, builder=_LXML_BUILDER, parse_only=strainer)
 
 
 def valid_tag(tag: Tag | NavigableString | None) -> Tag | None:
@@ -152,10 +241,25 @@ def __create_initial_settings():
         print(f"\t{i} - {municipality}")
     municipality = POSSIBLE_MUNICIPALITIES_LIST[int(input("Município: ")) - 1]
 
+    clear_screen()
+
+    print("Em qual formato o relatório da investigação deve ser salvo?")
+    for i, output_format in enumerate(POSSIBLE_OUTPUT_FORMATS_LIST, 1):
+        print(f"\t{i} - {output_format}")
+    output_format = POSSIBLE_OUTPUT_FORMATS_LIST[int(input("Formato: ")) - 1]
+
+    clear_screen()
+
+    workers = input(
+        f"Quantos pacientes podem ser investigados em paralelo? [padrão: {INVESTIGATION_WORKERS}]: "
+    ).strip()
+
     investigacao = {
         "agravo": agravo,
         "criterios": criterias,
         "municipio": municipality,
+        "output_format": output_format,
+        "workers": int(workers) if workers else INVESTIGATION_WORKERS,
     }
 
     return {
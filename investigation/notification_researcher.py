@@ -1,9 +1,12 @@
+import html
+import re
 import time
 from typing import Callable, Literal, Mapping, Optional
 
 import pandas as pd
 import requests
-from bs4 import BeautifulSoup
+from bs4 import SoupStrainer
+from lxml import html as lxml_html
 
 from core.constants import (
     POSSIBLE_AGRAVOS,
@@ -11,7 +14,7 @@ from core.constants import (
     SEARCH_POSSIBLE_CRITERIAS,
     SINAN_BASE_URL,
 )
-from core.utils import Printter, generate_search_base_payload, valid_tag
+from core.utils import Printter, generate_search_base_payload, parse_html
 from investigation.patient import Patient
 from investigation.report import Report
 from investigation.sheet import Sheet
@@ -19,6 +22,85 @@ from investigation.sheet import Sheet
 display = Printter("PESQUISA")
 
 
+SEARCH_CHUNK_SIZE = 65536
+"""Size (bytes) of each chunk of the search response fed to the parser"""
+
+_VIEW_STATE_RE = re.compile(rb'javax\.faces\.ViewState[^>]*value="([^"]+)"')
+"""Extract the `javax.faces.ViewState` value from a (full or ajax) response"""
+
+_FIELD_TYPE_SELECT_RE = re.compile(
+    rb'<select[^>]*id="form:consulta_tipoCampo"[^>]*>(.*?)</select>', re.I | re.S
+)
+"""Extract the options of the criteria field (`form:consulta_tipoCampo`) from the search page"""
+
+_OPTION_RE = re.compile(
+    rb'<option[^>]*value="([^"]*)"[^>]*>(.*?)</option>', re.I | re.S
+)
+"""Extract the value and the text of each `<option>`"""
+
+_DECLARED_CHARSET_RE = re.compile(
+    rb"""<meta[^>]*charset=["']?([\w.:-]+)|<\?xml[^>]*encoding=["']([\w.:-]+)""", re.I
+)
+"""Extract the charset declared inside the page (`<meta>` or xml declaration)"""
+
+_OPERATOR_STRAINER = SoupStrainer("select", {"id": "form:consulta_operador"})
+"""Restrict the criteria field response parsing to the operator `<select>`"""
+
+
+def _header_charset(res: requests.Response) -> Optional[str]:
+    """Get the charset declared on the response `Content-Type` header
+
+    Requests assumes ISO-8859-1 for html without charset on the header, so that guess is ignored.
+
+    Args:
+        res (requests.Response): The response from the Sinan website
+
+    Returns:
+        Optional[str]: The charset, `None` if the header doesn't declare one
+    """
+    content_type = res.headers.get("Content-Type", "").lower()
+    return res.encoding if "charset" in content_type else None
+
+
+def _page_charset(res: requests.Response) -> str:
+    """Get the charset of a page (header, then the page declaration, then utf-8)
+
+    Args:
+        res (requests.Response): The response from the Sinan website
+
+    Returns:
+        str: The charset to decode the page
+    """
+    charset = _header_charset(res)
+    if charset:
+        return charset
+
+    declared = _DECLARED_CHARSET_RE.search(res.content)
+    if declared:
+        return (declared.group(1) or declared.group(2)).decode("ascii")
+    return "utf-8"
+
+
+def _parse_field_types(res: requests.Response) -> dict[str, str]:
+    """Map the criteria field options of the search page (text -> value)
+
+    Args:
+        res (requests.Response): The search page response
+
+    Returns:
+        dict[str, str]: The criteria field values by your option text
+    """
+    select = _FIELD_TYPE_SELECT_RE.search(res.content)
+    if not select:
+        return {}
+
+    charset = _page_charset(res)
+    return {
+        html.unescape(text.decode(charset, "replace")).strip(): value.decode(charset)
+        for value, text in _OPTION_RE.findall(select.group(1))
+    }
+
+
 class Criterias:
     """Criterias of notification research methods to improve the research filters"""
 
@@ -36,6 +118,7 @@ class Criterias:
         self.endpoint = endpoint
         self.criterias = criterias
         self.current_criterias = []
+        self.field_types: dict[str, str] = {}
 
     def __remove_criteria(self, criteria: SEARCH_POSSIBLE_CRITERIAS):
         """Send the payload to remove the one of the filter criterions
@@ -43,10 +126,9 @@ class Criterias:
         Args:
             criteria (SEARCH_POSSIBLE_CRITERIAS): The filter criterion to be removed
         """
-        payload = self.base_payload.copy()
         criteria_index = self.current_criterias.index(criteria)
         remove_criteria_key = f"form:j_id213:{criteria_index}:j_id215"
-        payload[remove_criteria_key] = remove_criteria_key
+        payload = self.base_payload | {remove_criteria_key: remove_criteria_key}
         self.session.post(self.endpoint, data=payload)
         self.current_criterias.pop(criteria_index)
 
@@ -55,15 +137,12 @@ class Criterias:
     ):
         """Send the payload to select the patient name criteria on search"""
 
-        payload = self.base_payload.copy()
-        payload.update(
-            {
-                "form:consulta_tipoCampo": field_type_id,
-                "form:consulta_operador": operator,
-                "form:consulta_dsTextoPesquisa": patient.name,
-                "form:btnAdicionarCriterio": "form:btnAdicionarCriterio",
-            }
-        )
+        payload = self.base_payload | {
+            "form:consulta_tipoCampo": field_type_id,
+            "form:consulta_operador": operator,
+            "form:consulta_dsTextoPesquisa": patient.name,
+            "form:btnAdicionarCriterio": "form:btnAdicionarCriterio",
+        }
 
         self.session.post(self.endpoint, data=payload)
         self.current_criterias.append("Nome do paciente")
@@ -72,15 +151,12 @@ class Criterias:
         self, patient: Patient, field_type_id: str, operator: str
     ):
         """Send the payload to select the patient notification number criteria on search"""
-        payload = self.base_payload.copy()
-        payload.update(
-            {
-                "form:consulta_tipoCampo": field_type_id,
-                "form:consulta_operador": operator,
-                "form:consulta_dsTextoPesquisa": patient.notification_number,
-                "form:btnAdicionarCriterio": "form:btnAdicionarCriterio",
-            }
-        )
+        payload = self.base_payload | {
+            "form:consulta_tipoCampo": field_type_id,
+            "form:consulta_operador": operator,
+            "form:consulta_dsTextoPesquisa": patient.notification_number,
+            "form:btnAdicionarCriterio": "form:btnAdicionarCriterio",
+        }
         self.session.post(self.endpoint, data=payload)
         self.current_criterias.append("Número da Notificação")
 
@@ -88,15 +164,12 @@ class Criterias:
         self, patient: Patient, field_type_id: str, operator: str
     ):
         """Send the payload to select the patient date of birth criteria on search"""
-        payload = self.base_payload.copy()
-        payload.update(
-            {
-                "form:consulta_tipoCampo": field_type_id,
-                "form:consulta_operador": operator,
-                "form:consulta_dsTextoPesquisa": patient.f_birth_date,
-                "form:btnAdicionarCriterio": "form:btnAdicionarCriterio",
-            }
-        )
+        payload = self.base_payload | {
+            "form:consulta_tipoCampo": field_type_id,
+            "form:consulta_operador": operator,
+            "form:consulta_dsTextoPesquisa": patient.f_birth_date,
+            "form:btnAdicionarCriterio": "form:btnAdicionarCriterio",
+        }
 
         self.session.post(self.endpoint, data=payload)
         self.current_criterias.append("Data de nascimento")
@@ -105,15 +178,12 @@ class Criterias:
         self, patient: Patient, field_type_id: str, operator: str
     ):
         """Send the payload to select the patient month name criteria on search"""
-        payload = self.base_payload.copy()
-        payload.update(
-            {
-                "form:consulta_tipoCampo": field_type_id,
-                "form:consulta_operador": operator,
-                "form:consulta_dsTextoPesquisa": patient.mother_name,
-                "form:btnAdicionarCriterio": "form:btnAdicionarCriterio",
-            }
-        )
+        payload = self.base_payload | {
+            "form:consulta_tipoCampo": field_type_id,
+            "form:consulta_operador": operator,
+            "form:consulta_dsTextoPesquisa": patient.mother_name,
+            "form:btnAdicionarCriterio": "form:btnAdicionarCriterio",
+        }
 
         self.session.post(self.endpoint, data=payload)
         self.current_criterias.append("Nome da mãe")
@@ -127,33 +197,22 @@ class Criterias:
         Returns:
             str: The field type value
         """
+        field_type_value = self.field_types.get(criteria)
 
-        options = self.soup.find("select", {"id": "form:consulta_tipoCampo"}).find_all(  # type: ignore
-            "option"
-        )
-        field_type = next(
-            (option for option in options if option.text.strip() == criteria),
-            None,
-        )
-
-        if not field_type:
+        if not field_type_value:
             display(
                 f"Critério fornecido ({criteria}) não foi encontrado.", category="erro"
             )
             exit(1)
 
-        field_type_value = field_type.get("value")
-        payload = self.base_payload.copy()
-        payload.update(
-            {
-                "form:consulta_tipoCampo": field_type_value,
-                "form:j_id161": "Selecione valor no campo",
-                "form:j_id136": "form:j_id136",
-                "ajaxSingle": "form:consulta_tipoCampo",
-            }
-        )
+        payload = self.base_payload | {
+            "form:consulta_tipoCampo": field_type_value,
+            "form:j_id161": "Selecione valor no campo",
+            "form:j_id136": "form:j_id136",
+            "ajaxSingle": "form:consulta_tipoCampo",
+        }
         res = self.session.post(self.endpoint, data=payload)
-        soup = BeautifulSoup(res.content, "html.parser")
+        soup = parse_html(res.content, _OPERATOR_STRAINER)
         operator_options = soup.find(
             "select", {"id": "form:consulta_operador"}
         ).find_all("option")  # type: ignore
@@ -198,6 +257,12 @@ class NotificationResearcher(Criterias):
         consultar(self, patient: str): Consult a notification and return the response
     """
 
+    SELECT_AGRAVO_PAYLOAD = {"form:j_id108": "form:j_id108", "AJAX:EVENTS_COUNT": "1"}
+    """Static fields of the payload that selects the agravo (merged into the base payload)"""
+
+    SEARCH_PAYLOAD = {"form:btnPesquisar": "form:btnPesquisar"}
+    """Static fields of the payload that submits the search (merged into the base payload)"""
+
     def __init__(
         self,
         session: requests.Session,
@@ -215,42 +280,41 @@ class NotificationResearcher(Criterias):
 
     def __select_agravo(self):
         """Send the payload to select the agravo"""
-        payload = self.base_payload.copy()
-        payload.update(
-            {
-                "form:j_id108": "form:j_id108",
-                "AJAX:EVENTS_COUNT": "1",
-            }
-        )
+        payload = self.base_payload | self.SELECT_AGRAVO_PAYLOAD
         self.session.post(self.endpoint, data=payload)
 
-    def __search(self):
+    def __search(self) -> Optional[lxml_html.HtmlElement]:
         """Send the payload to search the notification given the patient name
 
+        The response is parsed while it is downloaded (overlapping network and parsing).
+
         Returns:
-            requests.Response: The response from the Sinan website
+            Optional[lxml_html.HtmlElement]: The parsed response from the Sinan website
+                (`None` if the response is empty)
         """
-        payload = self.base_payload.copy()
-        payload.update(
-            {
-                "form:btnPesquisar": "form:btnPesquisar",
-            }
-        )
-        res = self.session.post(self.endpoint, data=payload)
-        return res
+        payload = self.base_payload | self.SEARCH_PAYLOAD
+        res = self.session.post(self.endpoint, data=payload, stream=True)
+
+        # without a charset on the header lxml detects the one declared on the page
+        parser = lxml_html.HTMLParser(encoding=_header_charset(res))
+        received = False
+        for chunk in res.iter_content(SEARCH_CHUNK_SIZE):
+            parser.feed(chunk)
+            received = True
+        return parser.close() if received else None
 
     def __define_javax_faces(self):
         """Loads endpoint page and extract the javax.faces.ViewState this session"""
         res = self.session.get(self.endpoint)
-        self.soup = BeautifulSoup(res.content, "html.parser")
-        javax_faces = valid_tag(
-            self.soup.find("input", {"name": "javax.faces.ViewState"})
-        )
+        self.field_types = _parse_field_types(res)
+        javax_faces = _VIEW_STATE_RE.search(res.content)
         if not javax_faces:
             display("Token de estado de visualização não encontrado.", category="erro")
             exit(1)
 
-        self.base_payload["javax.faces.ViewState"] = javax_faces.get("value")  # type: ignore
+        self.base_payload["javax.faces.ViewState"] = javax_faces.group(1).decode()
+        # a new view starts without criterias
+        self.current_criterias = []
 
     def __check_mother_names(
         self, results: list[Sheet], strategy: Literal["equal", "contains"] = "equal"
@@ -366,36 +430,33 @@ class NotificationResearcher(Criterias):
         self.reporter.clean_patient()
         return results
 
-    def __treat_results(self, res: requests.Response) -> list[Sheet]:
+    def __treat_results(self, tree: Optional[lxml_html.HtmlElement]) -> list[Sheet]:
         """This will receive the search response from the sinan website and will return a list of dicts with the results
 
         Args:
-            res (requests.Response): The response from the sinan website
+            tree (Optional[lxml_html.HtmlElement]): The parsed response from the sinan website
 
         Returns:
             list[Sheet]: A list of dicts with the results
         """
-        soup = BeautifulSoup(res.content, "html.parser")
-        reult_tag = soup.find("span", {"id": "form:panelResultadoPesquisa"})
-        thead = valid_tag(soup.find("thead", {"class": "rich-table-thead"}))
-        tbody = valid_tag(soup.find("tbody", {"id": "form:tabelaResultadoPesquisa:tb"}))
+        if tree is None:
+            return []
 
-        if not (thead and tbody and reult_tag):
+        reult_tag = tree.xpath('//span[@id="form:panelResultadoPesquisa"]')
+        ths = tree.xpath('//thead[contains(@class, "rich-table-thead")]//th')
+        rows = tree.xpath('//tbody[@id="form:tabelaResultadoPesquisa:tb"]/tr')
+
+        if not (ths and reult_tag):
             return []
 
-        column_names = [th.span.text.strip() for th in thead.find_all("th")]
+        column_names = [th.xpath("string(.//span)").strip() for th in ths]
         sheets: list[Sheet] = []
 
-        for i, row in enumerate(tbody.find_all("tr"), 0):
-            row_values = [td.text.strip() for td in row.find_all("td")]
+        for i, row in enumerate(rows, 0):
+            row_values = [td.text_content().strip() for td in row.xpath("./td")]
             value = dict(zip(column_names, row_values))
-            payload = self.base_payload.copy()
-
-            payload.update(
-                {
-                    f"form:tabelaResultadoPesquisa:{i}:visualizarNotificacao": f"form:tabelaResultadoPesquisa:{i}:visualizarNotificacao"
-                }
-            )
+            open_key = f"form:tabelaResultadoPesquisa:{i}:visualizarNotificacao"
+            payload = self.base_payload | {open_key: open_key}
 
             sheet = Sheet(
                 self.session,
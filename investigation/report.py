@@ -1,5 +1,8 @@
+import csv
 import json
+import threading
 from datetime import datetime
+from pathlib import Path
 from typing import Literal, Union
 
 import pandas as pd
@@ -8,6 +11,9 @@ from openpyxl.styles import Border, PatternFill, Side
 from core.constants import (
     EXAMS_GAL_MAP,
     EXECUTION_DATE,
+    POSSIBLE_OUTPUT_FORMATS,
+    POSSIBLE_OUTPUT_FORMATS_LIST,
+    REPORT_OUTPUT_FORMAT,
     SCRIPT_GENERATED_PATH,
     UNIVERSAL_STATS_FILE_PATH,
 )
@@ -17,7 +23,21 @@ from investigation.patient import Patient
 class Report:
     """The Report Generator to friendly-read investigation progress"""
 
-    def __init__(self):
+    def __init__(self, output_format: POSSIBLE_OUTPUT_FORMATS = REPORT_OUTPUT_FORMAT):
+        """Initialize the Report
+
+        Args:
+            output_format (POSSIBLE_OUTPUT_FORMATS, optional): The report file format. Defaults to "parquet".
+
+        Raises:
+            ValueError: Unsupported report file format
+        """
+        if output_format not in POSSIBLE_OUTPUT_FORMATS_LIST:
+            raise ValueError(
+                f"Unsupported report format: {output_format} "
+                f"(options: {', '.join(POSSIBLE_OUTPUT_FORMATS_LIST)})"
+            )
+        self.output_format: POSSIBLE_OUTPUT_FORMATS = output_format
         self.columns = [
             "Nº de Notificação (GAL)",
             "Nome do Paciente",
@@ -36,7 +56,9 @@ class Report:
         self.df = self.df[self.columns]
 
         self.__messages_stack = []
-        self.__current_patient = {}
+        # each worker thread reports about your own patient
+        self.__local = threading.local()
+        self.__lock = threading.RLock()
 
         self.__importance_map = {
             "debug": "Informação Simples",
@@ -101,7 +123,7 @@ class Report:
             patient (dict): The patient data from GAL
         """
         exam_type = patient.exam_type
-        self.__current_patient = {
+        self.__local.current_patient = {
             "Nº de Notificação (GAL)": patient.notification_number,
             "Nome do Paciente": patient.name,
             "Nome da Mãe": patient.mother_name,
@@ -114,7 +136,26 @@ class Report:
 
     def clean_patient(self):
         """Clean the current patient data"""
-        self.__current_patient = {}
+        self.__local.current_patient = {}
+
+    def buffer_messages(self):
+        """Hold the next messages of the current thread until `flush_messages` is called
+
+        Keeps the messages of a patient together on the report while other workers
+        are reporting about other patients.
+        """
+        self.__local.buffer = []
+
+    def flush_messages(self):
+        """Add the messages held by `buffer_messages` to the report (all at once)"""
+        rows = getattr(self.__local, "buffer", None)
+        self.__local.buffer = None
+        if not rows:
+            return
+
+        with self.__lock:
+            self.__messages_stack.extend(rows)
+            self.__append_progress(rows)
 
     def __apply_colors(self, worksheet):
         """Apply colors to cells in 'Categoria da Mensagem' column based on importance"""
@@ -141,14 +182,65 @@ class Report:
             cell.fill = fill_pattern
             cell.border = thin_border
 
+    @property
+    def __progress_path(self) -> Path:
+        """Path of the csv file where the messages are appended during the execution"""
+        return SCRIPT_GENERATED_PATH / Path(str(self.__reports_filename)).with_suffix(
+            ".progresso.csv"
+        )
+
+    def __append_progress(self, rows: list[dict]):
+        """Append the messages to the progress csv file (cheap to write, keeps the progress if the bot crashes)
+
+        Args:
+            rows (list[dict]): The messages to append
+        """
+        if self.__reports_filename is None:
+            return
+
+        path = self.__progress_path
+        write_header = not path.exists()
+        with path.open("a", newline="", encoding="utf-8") as f:
+            writer = csv.DictWriter(
+                f, fieldnames=self.columns, delimiter=";", extrasaction="ignore"
+            )
+            if write_header:
+                writer.writeheader()
+            writer.writerows(rows)
+
+    def export(self):
+        """Export all the messages to the report file (should be called once, at the end of the execution)"""
+        with self.__lock:
+            if self.__messages_stack:
+                self.df = pd.DataFrame(self.__messages_stack)
+            self.__export()
+
     def __export(self):
-        """Export the current dataframe to an excel file if the filename is defined"""
+        """Export the current dataframe to the report file if the filename is defined"""
         if self.__reports_filename is None:
             return
 
-        writer = pd.ExcelWriter(
-            SCRIPT_GENERATED_PATH / self.__reports_filename, engine="openpyxl"
-        )
+        path = SCRIPT_GENERATED_PATH / self.__reports_filename
+        match self.output_format:
+            case "parquet":
+                self.__update_stats_df()
+                # messages mix numbers and text on the same columns
+                self.df.astype("string").to_parquet(
+                    path, engine="pyarrow", compression="zstd", index=False
+                )
+            case "csv":
+                self.__update_stats_df()
+                self.df.to_csv(path, sep=";", index=False)
+            case "xlsx":
+                self.__export_excel(path)
+
+    def __export_excel(self, path: Path):
+        """Export the current dataframe and the stats to an excel file
+
+        Args:
+            path (Path): The excel file path
+        """
+        writer = pd.ExcelWriter(path, engine="openpyxl")
         self.df.to_excel(writer, sheet_name="Relatório", index=False)
 
         self.__update_stats_df()
@@ -178,11 +270,11 @@ class Report:
         else:
             release_dates = max_release_date
 
-        exams = ", ".join(map(lambda e: EXAMS_GAL_MAP[e], data["Exame"].unique()))
+        exams = ", ".join(sorted({EXAMS_GAL_MAP[e] for e in data["Exame"].unique()}))
         run_datetime = EXECUTION_DATE.strftime("%d.%m.%Y às %Hh%M")
-        self.__reports_filename = f"Investigação ({exams}) - liberação {release_dates} - execução {run_datetime}.xlsx"
+        self.__reports_filename = f"Investigação ({exams}) - liberação {release_dates} - execução {run_datetime}.{self.output_format}"
         print(f"[RELATORIO] Nome do relatório: {self.__reports_filename}")
-        self.__export()
+        self.__append_progress(self.__messages_stack)
 
     def __add_message(
         self,
@@ -197,7 +289,7 @@ class Report:
             importance (int, optional): The message importance mapped. Defaults to 0.
             observation (str, optional): Some observation about the message. Defaults to "".
         """
-        row = self.__current_patient.copy()
+        row = getattr(self.__local, "current_patient", {}).copy()
         if row.get("Nome do Paciente") is None:
             observation = (
                 f"{observation} (Esta é uma mensagem sem relação à algum paciente)"
@@ -212,10 +304,14 @@ class Report:
             }
         )
 
-        self.__messages_stack.append(row)
-        self.df = pd.DataFrame(self.__messages_stack)
+        buffer = getattr(self.__local, "buffer", None)
+        if buffer is not None:
+            buffer.append(row)
+            return
 
-        self.__export()
+        with self.__lock:
+            self.__messages_stack.append(row)
+            self.__append_progress([row])
 
     def debug(self, message: str, observation: str = ""):
         """Add a debug message (Importance: Informação Simples)
@@ -285,23 +381,24 @@ class Report:
             key (str): The key to increment
             value (Union[int, float], optional): The value to increment. Defaults to 1.
         """
-        self.stats[key] = self.stats.get(key, 0) + value
+        with self.__lock:
+            self.stats[key] = self.stats.get(key, 0) + value
 
-        self.stats["average_search_time"] = (
-            self.stats["search_time"] / (self.stats["patients"])
-            if self.stats["patients"] > 0
-            else 0
-        )
-        self.stats["average_investigation_time"] = (
-            self.stats["investigation_time"] / (self.stats["investigated"])
-            if self.stats["investigated"] > 0
-            else 0
-        )
-        self.stats["average_notifications_found"] = (
-            self.stats["notifications"] / (self.stats["patients"])
-            if self.stats["patients"] > 0
-            else 0
-        )
+            self.stats["average_search_time"] = (
+                self.stats["search_time"] / (self.stats["patients"])
+                if self.stats["patients"] > 0
+                else 0
+            )
+            self.stats["average_investigation_time"] = (
+                self.stats["investigation_time"] / (self.stats["investigated"])
+                if self.stats["investigated"] > 0
+                else 0
+            )
+            self.stats["average_notifications_found"] = (
+                self.stats["notifications"] / (self.stats["patients"])
+                if self.stats["patients"] > 0
+                else 0
+            )
 
     def __update_stats_df(self):
         """Update the stats dataframe"""
@@ -1,10 +1,21 @@
 # sinan.py
+import html
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from core.abstract import Bot
-from core.constants import SINAN_BASE_URL, USER_AGENT
-from core.utils import Printter, valid_tag
+from core.constants import (
+    INVESTIGATION_WORKERS,
+    REPORT_OUTPUT_FORMAT,
+    SINAN_BASE_URL,
+    USER_AGENT,
+)
+from core.utils import Printter, normalize_name, parse_html
 from investigation.data_loader import SinanGalData
 from investigation.investigator import DuplicateChecker
 from investigation.notification_researcher import NotificationResearcher
@@ -13,6 +24,18 @@ from investigation.report import Report
 
 display = Printter("SINAN")
 
+_FORM_RE = re.compile(r'<form\b[^>]*\baction="([^"]*)"[^>]*>(.*?)</form>', re.I | re.S)
+"""Extract the action and the content of a `<form>`"""
+
+_INPUT_RE = re.compile(r"<input\b[^>]*>", re.I)
+"""Extract each `<input>` tag"""
+
+_INPUT_NAME_RE = re.compile(r'\bname="([^"]*)"', re.I)
+"""Extract the `name` attribute of a tag"""
+
+_INPUT_VALUE_RE = re.compile(r'\bvalue="([^"]*)"', re.I)
+"""Extract the `value` attribute of a tag"""
+
 
 class InvestigationBot(Bot):
     """Sinan client that will be used to interact with the Sinan Website doing things like:
@@ -25,7 +48,13 @@ class InvestigationBot(Bot):
         self._username = settings["sinan_credentials"]["username"]
         self._password = settings["sinan_credentials"]["password"]
         self._settings = settings
-        self.reporter = Report()
+        self._workers = settings["sinan_investigacao"].get(
+            "workers", INVESTIGATION_WORKERS
+        )
+        self._worker_apps = threading.local()
+        self.reporter = Report(
+            settings["sinan_investigacao"].get("output_format", REPORT_OUTPUT_FORMAT)
+        )
         # self.reporter._example()  # Just for testing purposes
 
         self._init_apps()
@@ -36,30 +65,73 @@ class InvestigationBot(Bot):
         self.data.load()
         self.reporter.generate_reports_filename(self.data.df)
 
+    def __new_session(self) -> requests.Session:
+        """Create a session agent that will be used to make requests
+
+        Returns:
+            requests.Session: A new (not logged) session
+        """
+        session = requests.session()
+        session.headers.update({"User-Agent": USER_AGENT})
+
+        # each session is used by a single thread against a single host, so one kept
+        # alive connection is enough. Only idempotent requests are retried on gateway
+        # errors (the default `allowed_methods` excludes POST, which changes the JSF view)
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=1,
+            max_retries=Retry(
+                total=3,
+                backoff_factor=0.3,
+                status_forcelist=[502, 503, 504],
+                # return the last response instead of raising RetryError
+                raise_on_status=False,
+            ),
+        )
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
     def __create_session(self):
-        """Create a session agent that will be used to make requests"""
-        self.session = requests.session()
-        self.session.headers.update({"User-Agent": USER_AGENT})
+        """Create the main session agent (used to validate the credentials)"""
+        self.session = self.__new_session()
 
-    def __create_notification_researcher(self):
-        """Create a notification searcher that will be used to research notifications given a patient"""
+    def __create_notification_researcher(self, session: requests.Session):
+        """Create a notification searcher that will be used to research notifications given a patient
+
+        Args:
+            session (requests.Session): The logged session used by the researcher
+
+        Returns:
+            NotificationResearcher: The notification researcher
+        """
         agravo = self._settings["sinan_investigacao"]["agravo"]
         criterios = self._settings["sinan_investigacao"]["criterios"]
         municipality = self._settings["sinan_investigacao"]["municipio"]
-        self.researcher = NotificationResearcher(
-            self.session, agravo, municipality, criterios, self.reporter
+        return NotificationResearcher(
+            session, agravo, municipality, criterios, self.reporter
         )
 
-    def __create_duplicate_checker(self):
-        """Create a duplicate checker instance that will be used to analyze duplicates"""
-        self.duplicate_checker = DuplicateChecker(self.session, self.reporter)
+    def __get_worker_apps(self) -> tuple[NotificationResearcher, DuplicateChecker]:
+        """Get the apps of the current worker thread, logging a new session on the first call
+
+        The Sinan keeps the search state (JSF view) by session, so each worker needs your own login.
+
+        Returns:
+            tuple[NotificationResearcher, DuplicateChecker]: The apps of the current worker
+        """
+        apps = self._worker_apps
+        if not hasattr(apps, "researcher"):
+            session = self.__new_session()
+            self._login(session)
+            apps.researcher = self.__create_notification_researcher(session)
+            apps.duplicate_checker = DuplicateChecker(session, self.reporter)
+        return apps.researcher, apps.duplicate_checker
 
     def _init_apps(self):
         """Factory method to initialize the apps"""
         initializators = [
             self.__create_session,
-            self.__create_notification_researcher,
-            self.__create_duplicate_checker,
             self.__create_data_manager,
         ]
 
@@ -72,27 +144,26 @@ class InvestigationBot(Bot):
         Args:
             res (requests.Response): The response from the sinan website
         """
-        soup = BeautifulSoup(res.content, "html.parser")
+        soup = parse_html(res.content)
         if not soup.find("div", {"id": "detalheUsuario"}):
             display("Falha ao tentar logar. Verifique as credenciais.", category="erro")
             exit(1)
 
-        # update the apps that use the session
-        need_session = [self.researcher, self.duplicate_checker]
-        for app in need_session:
-            setattr(app, "session", self.session)
+    def _login(self, session: requests.Session | None = None):
+        """Login to the Sinan Website
 
-    def _login(self):
-        """Login to the Sinan Website"""
+        Args:
+            session (requests.Session | None, optional): The session to log in. Defaults to the main session.
+        """
+        session = session or self.session
         display(
             "Fazendo login utilizando as credenciais fornecidas...", category="info"
         )
 
         # set JSESSIONID
-        res = self.session.get(f"{SINAN_BASE_URL}/sinan/login/login.jsf")
+        res = session.get(f"{SINAN_BASE_URL}/sinan/login/login.jsf")
 
-        soup = BeautifulSoup(res.content, "html.parser")
-        form = valid_tag(soup.find("form"))
+        form = _FORM_RE.search(res.text)
         if not form:
             display(
                 "Erro: Nenhum formulário encontrado. (pode ser que o site tenha atualizado)",
@@ -100,18 +171,23 @@ class InvestigationBot(Bot):
             )
             exit(1)
 
-        inputs = form.find_all("input")
+        action, form_content = form.groups()
         payload = dict()
-        for input_ in inputs:
-            name, value = input_.get("name"), input_.get("value")
+        for input_ in _INPUT_RE.findall(form_content):
+            name = _INPUT_NAME_RE.search(input_)
+            if not name:
+                continue
+            name = html.unescape(name.group(1))
+            value = _INPUT_VALUE_RE.search(input_)
+            value = html.unescape(value.group(1)) if value else None
             if "username" in name:
                 value = self._username
             elif "password" in name:
                 value = self._password
             payload[name] = value
 
-        res = self.session.post(
-            f"{SINAN_BASE_URL}{form.get('action')}",
+        res = session.post(
+            f"{SINAN_BASE_URL}{html.unescape(action)}",
             data=payload,
             headers={"Content-Type": "application/x-www-form-urlencoded"},
         )
@@ -124,8 +200,9 @@ class InvestigationBot(Bot):
         Args:
             patient (Patient): The patient data
         """
+        researcher, duplicate_checker = self.__get_worker_apps()
         self.reporter.increment_stat("patients")
-        sheets = self.researcher.search(patient)
+        sheets = researcher.search(patient)
 
         self.reporter.set_patient(patient)
         match len(sheets):
@@ -150,19 +227,65 @@ class InvestigationBot(Bot):
                 )
                 self.reporter.warn("Paciente tem mais de 1 resultado (duplicidade).")
                 self.reporter.increment_stat("duplicates")
-                self.duplicate_checker.investigate_multiple(patient, sheets)
+                duplicate_checker.investigate_multiple(patient, sheets)
+
+    def __investigate(self, i: int, total: int, patient: Patient):
+        """Investigate one patient (runs inside a worker thread)
+
+        Args:
+            i (int): The patient position (starting at 1)
+            total (int): The total of patients
+            patient (Patient): The patient data
+        """
+        display(
+            f"[{i} de {total}] Preenchendo investigação do paciente {patient.name}...",
+            category="info",
+        )
+        self.__fill_form(patient)
+        display("\n" + "*" * 25, category="info", end="\n\n")
+
+    def __investigate_group(self, group: list[tuple[int, Patient]], total: int):
+        """Investigate in order the rows of the same patient (runs inside a worker thread)
+
+        Args:
+            group (list[tuple[int, Patient]]): The patient rows with your positions
+            total (int): The total of patients
+        """
+        # the report keeps the messages of the patient together
+        self.reporter.buffer_messages()
+        try:
+            for i, patient in group:
+                self.__investigate(i, total, patient)
+        finally:
+            self.reporter.flush_messages()
 
     def start(self):
         """Start the investigation bot process"""
         self._login()
         total = len(self.data.df)
-        for i, patient in self.data.df.iterrows():
-            i += 1  # type: ignore
-            patient = Patient(patient.to_dict())
-            display(
-                f"[{i} de {total}] Preenchendo investigação do paciente {patient.name}...",
-                category="info",
-            )
-            self.__fill_form(patient)
-            display("\n" + "*" * 25, category="info", end="\n\n")
-            # input("Pressione Enter para prosseguir para o próximo paciente.")
+
+        # rows of the same patient (eg. other exams) can reach the same notifications,
+        # so they are investigated in order by the same worker
+        groups: dict[str, list[tuple[int, Patient]]] = {}
+        records = self.data.df.to_dict(orient="records")
+        for i, record in enumerate(records, 1):
+            patient = Patient(record)
+            groups.setdefault(normalize_name(patient.name), []).append((i, patient))
+
+        executor = ThreadPoolExecutor(max_workers=self._workers)
+        try:
+            futures = [
+                executor.submit(self.__investigate_group, group, total)
+                for group in groups.values()
+            ]
+            for future in as_completed(futures):
+                # propagate the workers exceptions (eg. failed login)
+                future.result()
+        except BaseException:
+            # do not process the queued patients after an error or Ctrl+C
+            executor.shutdown(cancel_futures=True)
+            raise
+        else:
+            executor.shutdown()
+        finally:
+            self.reporter.export()